@@ -16,6 +16,11 @@ ASSETS_DIR = "assets"
 SERVER_HOSTS = ['pi-mocap-1.local', 'pi-mocap-2.local', 'pi-mocap-3.local', 'pi-mocap-4.local']
 # The network port for communication between the client and servers
 NETWORK_PORT = 65432
+# Each per-frame message is a header holding the frame index and the marker
+# count N (little-endian uint16 each), followed by N marker ids and then N
+# interleaved (x, y) centers in pixels, all stored as little-endian int16
+MESSAGE_HEADER_FORMAT = '<HH'
+MARKER_FIELD_DTYPE = '<i2'
 
 # --- Camera and Frame Settings ---
 FRAME_WIDTH = 1280  # Frame width in pixels for capture
@@ -26,6 +31,15 @@ FRAME_HEIGHT = 720  # Frame height in pixels for capture
 ARUCO_DICT = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_5X5_50)
 # The total number of unique markers in the dictionary being used
 NUM_MARKERS = 50
+# Scale factor applied to each frame before marker detection on the servers.
+# Detecting at half resolution processes a quarter of the pixels; the marker
+# centers remain accurate enough for triangulation.
+DETECT_SCALE = 0.5
+# Expected length of the smallest marker side as a fraction of the frame width.
+# The servers search a correspondingly downscaled image, which roughly halves
+# detection time, but markers much smaller than this may be missed. Lower it
+# (0 disables the limit) if distant markers drop out.
+MIN_MARKER_LENGTH_RATIO = 0.02
 # The size in pixels for the generated marker images (excluding the border)
 MARKER_SIZE_PX = 140
 # The width of the white border as a percentage of the marker size
@@ -55,6 +69,18 @@ PNP_DATA_FILE_PREFIX = "pnp_camera_pose"
 # --- Initial Distortion Calibration Settings ---
 # The dimensions of the physical chessboard pattern (number of inner corners)
 CHESSBOARD_DIMENSIONS = (9, 6)
+# Flags passed to cv2.findChessboardCorners when capturing calibration images.
+# CALIB_CB_FAST_CHECK rejects frames without a visible chessboard before the
+# expensive quad extraction runs, so failed captures return almost immediately.
+CHESSBOARD_FIND_FLAGS = (
+    cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE |
+    cv2.CALIB_CB_FAST_CHECK | cv2.CALIB_CB_FILTER_QUADS
+)
+# Maximum average width, in pixels, of the black-to-white edges on a detected
+# chessboard (see cv2.estimateChessboardSharpness). Sharp boards measure about
+# 1.5-2 px and a Gaussian blur of sigma 1.5 already exceeds 4 px, regardless of
+# image noise or background. Captures above this are rejected as blurred.
+CHESSBOARD_MAX_EDGE_WIDTH = 4.0
 # The dimensions for the generated chessboard image (number of squares)
 CHESSBOARD_SQUARES = (10, 7)
 # The size of each square in the generated chessboard image, in pixels
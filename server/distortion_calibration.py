@@ -9,24 +9,41 @@ import cv2
 import numpy as np
 import os
 import json
-from picamera2 import Picamera2
+from picamera2 import Picamera2, MappedArray
 import time
 import argparse
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # Add the project root to the Python path to allow importing 'config'
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import config
 
+# Encodes and writes captured images in the background
+io_pool = ThreadPoolExecutor(max_workers=2)
+# (path, future) for every write submitted to the I/O pool, checked before exiting
+pending_saves = []
+
+# Chessboard object points, like (0,0,0), (1,0,0), ..., shared by every calibration image
+OBJECT_POINTS = np.zeros((config.CHESSBOARD_DIMENSIONS[0] * config.CHESSBOARD_DIMENSIONS[1], 3), np.float32)
+OBJECT_POINTS[:, :2] = np.mgrid[0:config.CHESSBOARD_DIMENSIONS[0], 0:config.CHESSBOARD_DIMENSIONS[1]].T.reshape(-1, 2)
+# Indices of the four outer corners of the grid, in the same row-major order
+EDGE_INDICES = [
+    0, config.CHESSBOARD_DIMENSIONS[0] - 1,
+    len(OBJECT_POINTS) - config.CHESSBOARD_DIMENSIONS[0], len(OBJECT_POINTS) - 1
+]
+
 
 def initialize_camera():
     """Initializes and configures the Picamera2 instance."""
     print("Initializing Picamera2...")
     picam2 = Picamera2()
-    # Use a still configuration for higher quality captures
+    # Use a still configuration for higher quality captures. The lores stream
+    # is delivered in the ISP's native YUV420 format so its Y plane can be used
+    # directly as the grayscale image for chessboard detection.
     camera_cfg = picam2.create_still_configuration(
         main={"size": (config.FRAME_WIDTH, config.FRAME_HEIGHT)},
-        lores={"size": (config.FRAME_WIDTH, config.FRAME_HEIGHT)},
+        lores={"size": (config.FRAME_WIDTH, config.FRAME_HEIGHT), "format": "YUV420"},
         display="lores"
     )
     picam2.configure(camera_cfg)
@@ -37,6 +54,16 @@ def initialize_camera():
     return picam2
 
 
+def save_jpeg(path, image):
+    """Encodes an image as JPEG and writes it to disk."""
+    # JPEG is far cheaper on the Pi's CPU than compressing a PNG with libpng
+    ok, buf = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not ok:
+        raise RuntimeError(f"Could not encode image for '{path}'.")
+    with open(path, 'wb') as f:
+        f.write(buf)
+
+
 def capture_and_save_image(picam2, hostname):
     """
     Captures a single frame, searches for a chessboard pattern,
@@ -47,33 +74,85 @@ def capture_and_save_image(picam2, hostname):
     os.makedirs(output_dir, exist_ok=True)
 
     print("Capturing frame...")
-    frame = picam2.capture_array("main")
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    # Hold the request so the saved image comes from the same frame used for detection
+    request = picam2.capture_request()
+    try:
+        # Search the camera buffer in place rather than copying the whole frame out
+        with MappedArray(request, "lores") as mapped:
+            # The Y plane occupies the first FRAME_HEIGHT rows of a YUV420 buffer
+            gray = mapped.array[:config.FRAME_HEIGHT, :config.FRAME_WIDTH]
 
-    print(f"Searching for {config.CHESSBOARD_DIMENSIONS} chessboard pattern...")
-    ret, corners = cv2.findChessboardCorners(gray, config.CHESSBOARD_DIMENSIONS, None)
+            print(f"Searching for {config.CHESSBOARD_DIMENSIONS} chessboard pattern...")
+            ret, corners = cv2.findChessboardCorners(
+                gray, config.CHESSBOARD_DIMENSIONS, None, flags=config.CHESSBOARD_FIND_FLAGS
+            )
+            if ret:
+                # Sharpness is measured on the board's own edges, so neither the
+                # background nor sensor noise affects it
+                edge_width = cv2.estimateChessboardSharpness(gray, config.CHESSBOARD_DIMENSIONS, corners)[0][0]
+                if edge_width > config.CHESSBOARD_MAX_EDGE_WIDTH:
+                    print(f"FAILURE: Chessboard is too blurry ({edge_width:.1f} px edges). "
+                          "Hold it still and check the focus.")
+                    return False
+                # Keep the grayscale image beyond the mapping for the calibration cache
+                gray = gray.copy()
 
-    if ret:
-        # Find the next available image number to avoid overwriting
-        i = 0
-        while True:
-            img_filename = os.path.join(output_dir, f"calibration_{hostname}_{i}.png")
-            if not os.path.exists(img_filename):
-                break
-            i += 1
-        
-        cv2.imwrite(img_filename, frame)
-        print(f"SUCCESS: Chessboard found. Image saved to '{img_filename}'")
-        return True
+        if ret:
+            # Find the next available image number to avoid overwriting
+            i = 0
+            while True:
+                img_filename = os.path.join(output_dir, f"calibration_{hostname}_{i}.jpg")
+                if not os.path.exists(img_filename):
+                    break
+                i += 1
+
+            # Copy the frame out so the camera buffers can be released right away;
+            # JPEG encoding and the disk write happen on the I/O pool
+            pending_saves.append((img_filename, io_pool.submit(save_jpeg, img_filename, request.make_array("main"))))
+            # Cache the grayscale image next to the JPEG so calibration can skip decoding it
+            cache_filename = img_filename + '.npy'
+            pending_saves.append((cache_filename, io_pool.submit(np.save, cache_filename, gray)))
+            print(f"Chessboard found. Saving image to '{img_filename}'...")
+            return True
+        else:
+            print("FAILURE: Chessboard not found. Try a different angle or lighting.")
+            return False
+    finally:
+        # Return the buffers to the camera
+        request.release()
+
+
+def process_image(path):
+    """
+    Searches a saved calibration image for the chessboard pattern.
+
+    Returns a tuple of the refined corners and the image size, or None if the
+    pattern was not found.
+    """
+    cache_path = path + '.npy'
+    if os.path.exists(cache_path):
+        # Memory-map the cached grayscale image instead of decoding and converting the file
+        gray = np.load(cache_path, mmap_mode='r')
     else:
-        print("FAILURE: Chessboard not found. Try a different angle or lighting.")
-        return False
+        img = cv2.imread(path)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # The sector-based detector returns subpixel-accurate corners in a single pass,
+    # so no separate cornerSubPix refinement is needed
+    ret, corners = cv2.findChessboardCornersSB(
+        gray, config.CHESSBOARD_DIMENSIONS, flags=cv2.CALIB_CB_EXHAUSTIVE | cv2.CALIB_CB_ACCURACY
+    )
+    if not ret:
+        return None
+    return corners, gray.shape[::-1]
 
 
-def run_calibration_process():
+def run_calibration_process(edges_only=False):
     """
     Finds all captured calibration images, calculates the camera matrix
     and distortion coefficients, and saves them to a JSON file.
+
+    If edges_only is set, only the four outer corners of each chessboard are
+    used, which makes the solve much smaller at the cost of accuracy.
     """
     image_dir = os.path.join(os.path.dirname(__file__), '..', config.DISTORTION_IMAGES_FOLDER)
 
@@ -81,40 +160,39 @@ def run_calibration_process():
         print(f"Error: Image directory '{image_dir}' not found. Capture images first.")
         return False
 
-    # Termination criteria for the corner sub-pixel algorithm
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-
-    # Prepare object points, like (0,0,0), (1,0,0), ..., based on chessboard dimensions
-    objp = np.zeros((config.CHESSBOARD_DIMENSIONS[0] * config.CHESSBOARD_DIMENSIONS[1], 3), np.float32)
-    objp[:, :2] = np.mgrid[0:config.CHESSBOARD_DIMENSIONS[0], 0:config.CHESSBOARD_DIMENSIONS[1]].T.reshape(-1, 2)
-
-    objpoints = []  # 3D points in real-world space
-    imgpoints = []  # 2D points in the image plane
-    
-    images = [f for f in os.listdir(image_dir) if f.startswith('calibration_') and f.endswith('.png')]
+    images = [f for f in os.listdir(image_dir) if f.startswith('calibration_') and f.endswith(('.png', '.jpg'))]
     
     if len(images) < 15:
         print(f"Error: Calibration requires at least 15 images. Found only {len(images)}.")
         return False
 
     print(f"Processing {len(images)} images for calibration...")
-    for fname in images:
-        img = cv2.imread(os.path.join(image_dir, fname))
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        ret, corners = cv2.findChessboardCorners(gray, config.CHESSBOARD_DIMENSIONS, None)
-        if ret:
-            objpoints.append(objp)
-            # Refine corner locations for higher accuracy
-            corners2 = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
-            imgpoints.append(corners2)
+    # OpenCV releases the GIL, so the images are searched in parallel on all cores
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = list(executor.map(lambda fname: process_image(os.path.join(image_dir, fname)), images))
+
+    found = [result for result in results if result is not None]
+    imgpoints = [corners for corners, _ in found]  # 2D points in the image plane
+    objp = OBJECT_POINTS
+    if edges_only:
+        imgpoints = [corners[EDGE_INDICES] for corners in imgpoints]
+        objp = OBJECT_POINTS[EDGE_INDICES]
+    objpoints = [objp] * len(imgpoints)  # 3D points in real-world space
 
     if not objpoints:
         print("Error: Could not find chessboard in any of the processed images.")
         return False
 
+    image_size = found[0][1]
+
     print("Calibrating camera... This may take a moment.")
+    # The LU decomposition is faster than the default SVD for the internal linear solves.
+    # The principal point is held at the image center, which the Pi camera modules
+    # match closely; this removes two parameters and keeps the solution stable with
+    # only the minimum number of images.
     ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(
-        objpoints, imgpoints, gray.shape[::-1], None, None
+        objpoints, imgpoints, image_size, None, None,
+        flags=cv2.CALIB_USE_LU | cv2.CALIB_FIX_PRINCIPAL_POINT
     )
 
     if ret:
@@ -149,6 +227,11 @@ def main():
         action="store_true",
         help="Run calibration using all existing images in the calibration folder."
     )
+    parser.add_argument(
+        "--edges-only",
+        action="store_true",
+        help="Calibrate using only the four outer chessboard corners of each image. Faster, but less accurate."
+    )
     parser.add_argument(
         "--host",
         type=str,
@@ -163,17 +246,35 @@ def main():
 
     if args.capture:
         picam2 = None
+        saved = False
         try:
             picam2 = initialize_camera()
-            if not capture_and_save_image(picam2, args.host):
-                sys.exit(1)  # Exit with error code if capture fails
+            saved = capture_and_save_image(picam2, args.host)
         finally:
             if picam2:
                 picam2.stop()
                 print("Camera stopped.")
+            # Wait for the pending image saves to reach the disk. A failed write
+            # means the capture does not exist, so any partial files are removed.
+            errors = []
+            for _, future in pending_saves:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(e)
+            if errors:
+                print(f"Error: Could not save the captured image: {errors[0]}")
+                for path, _ in pending_saves:
+                    if os.path.exists(path):
+                        os.remove(path)
+                saved = False
+            io_pool.shutdown()
+        if not saved:
+            sys.exit(1)  # Exit with error code if capture fails
+        print("SUCCESS: Calibration image saved.")
     
     if args.calibrate:
-        if not run_calibration_process():
+        if not run_calibration_process(args.edges_only):
             sys.exit(1)  # Exit with error code if calibration fails
 
 
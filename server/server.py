@@ -6,18 +6,34 @@
 
 import cv2
 import numpy as np
-from picamera2 import Picamera2
+from numba import njit
+from picamera2 import Picamera2, MappedArray
 import time
 import socket
+import threading
+import queue
+import struct
 import json
 import os
 import sys
+import platform
 import logging
 
 # Add the project root to the Python path to allow importing 'config'
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import config
 
+# Binary wire format for the per-frame marker messages
+MESSAGE_HEADER = struct.Struct(config.MESSAGE_HEADER_FORMAT)
+MARKER_FIELD = np.dtype(config.MARKER_FIELD_DTYPE)
+
+# Size of the downscaled frames that markers are detected on
+DETECT_SIZE = (round(config.FRAME_WIDTH * config.DETECT_SCALE), round(config.FRAME_HEIGHT * config.DETECT_SCALE))
+
+# Stop refining an undistorted point once it is within a tenth of a pixel, since
+# the centers are sent as whole pixels
+UNDISTORT_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 10, 0.1)
+
 # --- Logging Setup ---
 # A separate log file is created for each server instance
 LOG_DIR = os.path.join(os.path.dirname(__file__), '..', 'server_logs')
@@ -61,80 +77,350 @@ def load_calibration_data(filepath):
         return None, None
 
 
+def check_cpu_optimizations():
+    """
+    Warns if OpenCV on an ARM host was built without NEON support.
+
+    Without NEON the image operations inside marker detection run on scalar
+    fallback paths, which is considerably slower on the Pi.
+    """
+    if not platform.machine().lower().startswith(('arm', 'aarch64')):
+        return
+    if not cv2.useOptimized():
+        logging.warning("OpenCV optimized code paths are disabled; enabling them.")
+        cv2.setUseOptimized(True)
+    cpu_features = [line for line in cv2.getBuildInformation().splitlines()
+                    if line.strip().startswith(('Baseline:', 'Dispatched code generation:'))]
+    if not any('NEON' in line for line in cpu_features):
+        logging.warning("OpenCV was built without NEON support; marker detection will be slower. "
+                        "See the README for installing an optimized build.")
+
+
 def initialize_camera():
     """Initializes and configures the Picamera2 instance for streaming."""
     picam2 = Picamera2()
-    # Use a preview configuration for lower latency video streaming
+    # Use a preview configuration for lower latency video streaming. Frames are
+    # delivered in the ISP's native YUV420 format, whose Y plane is the grayscale
+    # image the detector needs, so no colour conversion is required. The ISP also
+    # scales the lores stream down to the detection size at no CPU cost.
     camera_cfg = picam2.create_preview_configuration(
-        main={"size": (config.FRAME_WIDTH, config.FRAME_HEIGHT), "format": "BGR888"},
-        controls={"FrameDurationLimits": (33333, 33333)}  # Sets target to ~30 FPS
+        main={"size": (config.FRAME_WIDTH, config.FRAME_HEIGHT), "format": "YUV420"},
+        lores={"size": DETECT_SIZE, "format": "YUV420"},
+        controls={"FrameDurationLimits": (33333, 33333)},  # Sets target to ~30 FPS
+        # Every capture waits for a frame that starts after the request, instead of
+        # returning one already queued, so frames are never stale on arrival. Three
+        # buffers cover the frame being filled, one waiting in the grabber's queue
+        # and one being processed.
+        buffer_count=3,
+        queue=False
     )
     picam2.configure(camera_cfg)
     return picam2
 
 
-def stream_marker_data(conn, picam2, camera_matrix, dist_coeffs, detector):
+@njit(cache=True, fastmath=True)
+def marker_centers(corners, ids, num_markers):
     """
-    Captures frames, detects markers, and sends data to the connected client.
+    Computes the center of every marker whose ID is within the expected range.
+
+    corners is an (N, 4, 2) array of corner coordinates and ids the N detected
+    IDs. Returns the accepted IDs as an int32 array and their (x, y) centers.
     """
-    if not picam2.started:
-        picam2.start()
-        time.sleep(1.0) # Allow sensor to adjust
-        logging.info("Camera started for streaming.")
+    out_ids = np.empty(len(ids), np.int32)
+    out_centers = np.empty((len(ids), 2))
+    count = 0
+    for i in range(len(ids)):
+        if ids[i] < 0 or ids[i] >= num_markers:
+            continue
+        c = corners[i]
+        out_ids[count] = ids[i]
+        out_centers[count, 0] = (c[0, 0] + c[1, 0] + c[2, 0] + c[3, 0]) * 0.25
+        out_centers[count, 1] = (c[0, 1] + c[1, 1] + c[2, 1] + c[3, 1]) * 0.25
+        count += 1
+    return out_ids[:count], out_centers[:count]
 
-    # Pre-calculate the optimal new camera matrix for undistortion
-    h, w = config.FRAME_HEIGHT, config.FRAME_WIDTH
-    new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, dist_coeffs, (w, h), 1, (w, h))
 
-    while True:
-        frame_raw = picam2.capture_array()
-        
-        # Apply lens distortion correction
-        frame_undistorted = cv2.undistort(frame_raw, camera_matrix, dist_coeffs, None, new_camera_mtx)
-        
-        # Crop the image to the valid area to remove black borders
-        x, y, w_roi, h_roi = roi
-        frame = frame_undistorted[y:y + h_roi, x:x + w_roi]
-
-        frame_positions = []
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        corners, ids, _ = detector.detectMarkers(gray)
-
-        if ids is not None:
-            for i, marker_id in enumerate(ids.flatten()):
-                # Ensure the detected marker ID is within the expected range
-                if 0 <= marker_id < config.NUM_MARKERS:
-                    marker_corners = corners[i].reshape((4, 2))
-                    # Calculate the center of the marker
-                    cx = int(np.mean(marker_corners[:, 0]))
-                    cy = int(np.mean(marker_corners[:, 1]))
-                    
-                    position_data = {'id': int(marker_id), 'pos': [cx, cy]}
-                    frame_positions.append(position_data)
-        
-        if frame_positions:
+def message_size(count):
+    """Returns the size in bytes of a message carrying count markers."""
+    return MESSAGE_HEADER.size + 3 * count * MARKER_FIELD.itemsize
+
+
+@njit(cache=True)
+def _write_int16(out, pos, value):
+    """Writes value to out[pos:pos + 2] as a little-endian 16-bit integer."""
+    value &= 0xFFFF
+    out[pos] = value & 0xFF
+    out[pos + 1] = value >> 8
+
+
+@njit(cache=True)
+def encode_message(out, offset, frame_idx, marker_ids, centers):
+    """
+    Writes one marker message into the uint8 array out at offset.
+
+    The layout follows config.MESSAGE_HEADER_FORMAT and config.MARKER_FIELD_DTYPE:
+    the frame index and marker count, then the ids, then the interleaved centers,
+    which are truncated to whole pixels. Returns the offset just past the message.
+    """
+    count = len(marker_ids)
+    _write_int16(out, offset, frame_idx)
+    _write_int16(out, offset + 2, count)
+    pos = offset + 4
+    for i in range(count):
+        _write_int16(out, pos, marker_ids[i])
+        pos += 2
+    for i in range(count):
+        _write_int16(out, pos, int(centers[i, 0]))
+        _write_int16(out, pos + 2, int(centers[i, 1]))
+        pos += 4
+    return pos
+
+
+def put_latest(q, item):
+    """
+    Puts item on a bounded queue, dropping the oldest entry if the queue is full.
+
+    Returns the dropped entry, or None if nothing was dropped. Producers sharing
+    a queue must serialize their calls, or another put could take the freed slot.
+    """
+    dropped = None
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        # No other producer runs concurrently, so the freed slot stays free
+        try:
+            dropped = q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put_nowait(item)
+    return dropped
+
+
+class FrameGrabber(threading.Thread):
+    """
+    Captures frames in the background, keeping only the most recent one.
+
+    Frames are handed over as completed camera requests, so the image is read
+    straight from the camera buffer rather than copied out of it. The consumer
+    must release each request it takes from the queue.
+    """
+    def __init__(self, picam2):
+        super().__init__(daemon=True)
+        self.picam2 = picam2
+        # A single slot, so a slow consumer always receives the newest frame
+        self.queue = queue.Queue(maxsize=1)
+        self.stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                self.publish(self.picam2.capture_request())
+        except Exception as e:
+            logging.error(f"Frame capture failed: {e}", exc_info=True)
+            # Hand the error to the consumer, which would otherwise wait forever for a frame
+            self.publish(e)
+
+    def publish(self, item):
+        stale = put_latest(self.queue, item)
+        if stale is not None:
+            # Late frames are returned to the camera without being processed
+            stale.release()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if not isinstance(item, Exception):
+                item.release()
+
+
+class MessageSender(threading.Thread):
+    """
+    Encodes and sends queued marker results to the client, so neither
+    serialization nor a slow network holds up detection.
+    """
+    def __init__(self, conn):
+        super().__init__(daemon=True)
+        self.conn = conn
+        # A short queue caps latency; the oldest result is dropped when it is full
+        self.queue = queue.Queue(maxsize=2)
+        # Serializes the streaming thread's sends with stop(), which is called from
+        # the client's handler thread
+        self.lock = threading.Lock()
+        self.closed = False
+        # Encoding buffer reused across sends
+        self.buffer = np.empty(message_size(config.NUM_MARKERS), np.uint8)
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            # Coalesce any messages that queued up meanwhile into a single send
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if None in batch:
+                running = False
+                batch = batch[:batch.index(None)]
+            if not batch: break
+            # Encode the batch back to back so it goes out in a single send
+            size = sum(message_size(len(marker_ids)) for _, marker_ids, _ in batch)
+            if size > len(self.buffer):
+                self.buffer = np.empty(size, np.uint8)
+            offset = 0
+            for frame_idx, marker_ids, centers in batch:
+                offset = encode_message(self.buffer, offset, frame_idx, marker_ids, centers)
             try:
-                # Serialize the list of detected markers to JSON and send
-                data_to_send = json.dumps(frame_positions) + '\\n'
-                conn.sendall(data_to_send.encode('utf-8'))
+                self.conn.sendall(self.buffer[:offset])
             except (BrokenPipeError, ConnectionResetError):
                 logging.warning("Client disconnected during stream.")
-                break # Exit loop on connection error
+                self.close_connection()
+                break
+            except OSError as e:
+                # A client that drops off the network typically times out or becomes unreachable
+                logging.error(f"Failed to send to client: {e}")
+                self.close_connection()
+                break
+
+    def close_connection(self):
+        # Wake the handler's blocking recv so the client is unsubscribed
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send(self, frame_idx, marker_ids, centers):
+        with self.lock:
+            # The streaming thread may still hold this sender for a frame after it
+            # was removed; anything sent after stop() is discarded
+            if not self.closed:
+                put_latest(self.queue, (frame_idx, marker_ids, centers))
+
+    def stop(self):
+        with self.lock:
+            self.closed = True
+            # None is the shutdown sentinel, queued behind any pending messages.
+            # No send can follow it, so it is never the entry dropped.
+            put_latest(self.queue, None)
+        self.join()
+
+
+class MarkerPublisher:
+    """Tracks the connected clients that detection results are fanned out to."""
+    def __init__(self):
+        # The tuple is replaced, never mutated, so the streaming loop can iterate it without the lock
+        self.senders = ()
+        self.lock = threading.Lock()
+        self.has_clients = threading.Event()
+
+    def add(self, sender):
+        with self.lock:
+            self.senders = self.senders + (sender,)
+            self.has_clients.set()
+
+    def remove(self, sender):
+        with self.lock:
+            self.senders = tuple(s for s in self.senders if s is not sender)
+            if not self.senders:
+                self.has_clients.clear()
 
-def handle_client_connection(conn, addr, picam2, camera_matrix, dist_coeffs, detector):
+
+def stream_marker_data(publisher, picam2, camera_matrix, dist_coeffs, detector):
     """
-    Manages a single client connection, listening for commands and handling data streaming.
+    Captures frames, detects markers, and sends data to every connected client.
+
+    The camera is shared by all clients, so this runs on a single thread for the
+    lifetime of the server and only processes frames while at least one client is
+    connected.
+    """
+    while True:
+        publisher.has_clients.wait()
+        logging.info("Streaming started.")
+
+        # Capture, detection and sending run as a three-stage pipeline: frames are
+        # captured and messages sent on their own threads, so the sensor and the
+        # network keep working while this thread runs detection
+        grabber = FrameGrabber(picam2)
+        grabber.start()
+        frame_idx = 0
+        failed = False
+        try:
+            while publisher.has_clients.is_set():
+                request = grabber.queue.get()
+                if isinstance(request, Exception):
+                    raise request
+                frame_idx = (frame_idx + 1) & 0xFFFF
+
+                count = 0
+                try:
+                    with MappedArray(request, "lores") as mapped:
+                        # Markers are detected on the raw, distorted frame. The Y plane
+                        # occupies the first rows of a YUV420 buffer.
+                        gray = mapped.array[:DETECT_SIZE[1], :DETECT_SIZE[0]]
+                        corners, ids, _ = detector.detectMarkers(gray)
+                finally:
+                    # Return the buffer to the camera as soon as detection is done
+                    request.release()
+
+                if ids is not None:
+                    marker_ids, centers = marker_centers(np.concatenate(corners), ids.ravel(), config.NUM_MARKERS)
+                    count = len(marker_ids)
+                if count:
+                    # Map the centers back to full-resolution pixel coordinates
+                    centers = (centers + 0.5) / config.DETECT_SCALE - 0.5
+                    # Apply lens distortion correction to the marker centers only, rather
+                    # than to every pixel of the frame. Reprojecting with the original camera
+                    # matrix gives ideal pinhole coordinates the client can use without a
+                    # distortion model.
+                    centers = cv2.undistortPointsIter(
+                        centers.reshape(-1, 1, 2), camera_matrix, dist_coeffs, None, camera_matrix, UNDISTORT_CRITERIA
+                    ).reshape(-1, 2)
+                    # Encoding happens on each client's sender thread
+                    for sender in publisher.senders:
+                        sender.send(frame_idx, marker_ids, centers)
+        except Exception as e:
+            logging.error(f"An unexpected error occurred while streaming: {e}", exc_info=True)
+            failed = True
+        finally:
+            grabber.stop()
+            logging.info("Streaming stopped.")
+
+        if failed:
+            # Restart the camera before resuming, as reconnecting did when the
+            # camera was started for each client
+            try:
+                picam2.stop()
+                picam2.start()
+                time.sleep(1.0) # Allow sensor to adjust
+                logging.info("Camera restarted.")
+            except Exception as e:
+                logging.error(f"Failed to restart the camera: {e}", exc_info=True)
+                time.sleep(5.0)
+
+def handle_client_connection(conn, addr, publisher):
+    """
+    Manages a single client connection, subscribing it to the marker stream until it disconnects.
     """
     logging.info(f"Accepted connection from {addr}")
+    # Send each small per-frame message immediately instead of waiting on Nagle's algorithm
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # Leave room for a burst of messages if the client briefly stops reading
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 64 * 1024)
+    sender = MessageSender(conn)
+    sender.start()
+    # For this application, we immediately start streaming data upon connection
+    publisher.add(sender)
     try:
-        # For this application, we immediately start streaming data upon connection
-        stream_marker_data(conn, picam2, camera_matrix, dist_coeffs, detector)
+        # The client never sends anything, so recv only returns once the connection closes
+        while conn.recv(1024):
+            pass
+    except OSError:
+        pass
     except Exception as e:
         logging.error(f"An unexpected error occurred in client handler: {e}", exc_info=True)
     finally:
-        if picam2.started:
-            picam2.stop()
-            logging.info("Camera stream stopped.")
+        publisher.remove(sender)
+        sender.stop()
         conn.close()
         logging.info(f"Connection with {addr} closed.")
 
@@ -148,11 +434,44 @@ def main():
         logging.critical("Could not start server due to missing calibration data.")
         sys.exit(1)
 
+    check_cpu_optimizations()
+    # Compile (or load from cache) the centroid and encoding kernels before the first client connects
+    marker_centers(np.zeros((1, 4, 2), np.float32), np.zeros(1, np.int32), config.NUM_MARKERS)
+    encode_message(np.empty(message_size(1), np.uint8), 0, 0, np.zeros(1, np.int32), np.zeros((1, 2)))
+
     picam2 = initialize_camera()
+    # The camera runs for the lifetime of the server, so reconnecting clients
+    # do not wait for it to restart and settle
+    picam2.start()
+    time.sleep(1.0) # Allow sensor to adjust
+    logging.info("Camera started.")
 
     aruco_dict = config.ARUCO_DICT
     parameters = cv2.aruco.DetectorParameters()
+    # Tuned for the Pi's CPU: a single adaptive threshold window instead of a
+    # sweep over several sizes, and small contours rejected early so fewer
+    # candidates reach polygon approximation. Only marker centers are sent, so
+    # corner refinement is left off.
+    parameters.adaptiveThreshWinSizeMin = 13
+    parameters.adaptiveThreshWinSizeMax = 13
+    parameters.adaptiveThreshWinSizeStep = 10
+    parameters.minMarkerPerimeterRate = 0.05
+    parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_NONE
+    # ArUco3 detection thresholds a pyramid level sized to the smallest expected
+    # marker rather than the full image
+    parameters.useAruco3Detection = True
+    parameters.minSideLengthCanonicalImg = 16
+    parameters.minMarkerLengthRatioOriginalImg = config.MIN_MARKER_LENGTH_RATIO
     detector = cv2.aruco.ArucoDetector(aruco_dict, parameters)
+    # Run one detection on a blank frame of the streaming size so the detector's
+    # internal setup is not paid on the first frame a client receives
+    detector.detectMarkers(np.zeros((DETECT_SIZE[1], DETECT_SIZE[0]), np.uint8))
+
+    # A single streaming thread owns the camera and fans its results out to the clients
+    publisher = MarkerPublisher()
+    threading.Thread(
+        target=stream_marker_data, args=(publisher, picam2, camera_matrix, dist_coeffs, detector), daemon=True
+    ).start()
 
     HOST = '0.0.0.0'  # Listen on all available network interfaces
     PORT = config.NETWORK_PORT
@@ -166,14 +485,17 @@ def main():
         while True:
             try:
                 conn, addr = s.accept()
-                # Each client connection is handled sequentially
-                handle_client_connection(conn, addr, picam2, camera_matrix, dist_coeffs, detector)
+                # Each client connection is handled on its own thread
+                threading.Thread(target=handle_client_connection, args=(conn, addr, publisher), daemon=True).start()
             except KeyboardInterrupt:
                 logging.info("Shutdown signal received.")
                 break
             except Exception as e:
                 logging.error(f"Error in main accept loop: {e}", exc_info=True)
 
+    picam2.stop()
+    logging.info("Camera stopped.")
+
 if __name__ == "__main__":
     try:
         main()